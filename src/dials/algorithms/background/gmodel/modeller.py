@@ -123,16 +123,14 @@ def finalize(self):
 
     def compute(self, reflections):
         from dials.algorithms.background.gmodel import Fitter
-        from dials.array_family import flex
 
         assert self.finalized()
         fitter = Fitter(self.background)
         scale = fitter(reflections["shoebox"])
         success = scale >= 0
-        mean = flex.double(
-            [flex.mean(sbox.background) for sbox in reflections["shoebox"]]
-        )
-        reflections["background.mean"] = mean
+        reflections["background.mean"] = reflections[
+            "shoebox"
+        ].mean_background_model_all_pixels()
         reflections["background.scale"] = scale
         reflections.set_flags(~success, reflections.flags.dont_integrate)
         return success
@@ -604,7 +604,17 @@ def _complete_setup(self) -> None:
 
     def group_multiplicities(self, output: str = "per_group") -> np.array:
         """Return the multiplicities of the symmetry groups."""
-        return self.sum_in_groups(np.full(self.size, 1.0), output=output)
+        # Each reflection has exactly one entry in the index matrix, so the
+        # multiplicities are just the number of stored values in each column.
+        multiplicities = self._csc_h_index_matrix.getnnz(axis=0).astype(float)
+        if output == "per_group":
+            return multiplicities
+        elif output == "per_refl":
+            return multiplicities @ self._csc_h_expand_matrix
+        raise ValueError(
+            f"""Bad value for output= parameter
+(value={output}, allowed values: per_group, per_refl)"""
+        )
 
     def select(self, sel: np.array) -> "IhTableBlock":
         """Select a subset of the data, returning a new IhTableBlock object."""
@@ -685,7 +695,7 @@ def calc_nh(self) -> np.array:
         """Calculate the number of refls in the group to which the reflection belongs.
 
         This is a vector of length n_refl."""
-        return self.sum_in_groups(np.full(self.size, 1.0), output="per_refl")
+        return self.group_multiplicities(output="per_refl")
 
     def match_Ih_values_to_target(self, target_Ih_table: IhTable) -> None:
         """
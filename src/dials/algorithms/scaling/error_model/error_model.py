@@ -86,19 +86,50 @@
 
 def calc_sigmaprime(x, Ih_table) -> np.array:
     """Calculate the error from the model."""
-    sigmaprime = (
-        x[0] * np.sqrt(Ih_table.variances + np.square(x[1] * Ih_table.intensities))
-    ) / Ih_table.inverse_scale_factors
+    return _calc_sigmaprime(
+        x, Ih_table.variances, Ih_table.intensities, Ih_table.inverse_scale_factors
+    )
+
+
+def _calc_sigmaprime(x, variances, intensities, inverse_scale_factors, out=None):
+    # Evaluate in place to avoid allocating a temporary array for each step.
+    sigmaprime = np.multiply(x[1], intensities, out=out)
+    np.square(sigmaprime, out=sigmaprime)
+    sigmaprime += variances
+    np.sqrt(sigmaprime, out=sigmaprime)
+    sigmaprime *= x[0]
+    sigmaprime /= inverse_scale_factors
     return sigmaprime
 
 
-def calc_deltahl(Ih_table, n_h, sigmaprime) -> np.array:
-    """Calculate the normalised deviations from the model."""
-    I_hl = Ih_table.intensities
-    g_hl = Ih_table.inverse_scale_factors
-    I_h = Ih_table.Ih_values
-    prefactor = np.sqrt((n_h - np.full(n_h.size, 1.0)) / n_h)
-    delta_hl = prefactor * ((I_hl / g_hl) - I_h) / sigmaprime
+def calc_deltahl_prefactor(n_h) -> np.array:
+    """Calculate the multiplicity prefactor sqrt((n_h - 1)/n_h) of delta_hl."""
+    return np.sqrt((n_h - 1.0) / n_h)
+
+
+def calc_deltahl(Ih_table, n_h, sigmaprime, prefactor=None) -> np.array:
+    """Calculate the normalised deviations from the model.
+
+    The prefactor only depends on n_h, so can be precomputed with
+    calc_deltahl_prefactor and passed in when n_h is unchanged between calls."""
+    if prefactor is None:
+        prefactor = calc_deltahl_prefactor(n_h)
+    return _calc_deltahl(
+        Ih_table.intensities,
+        Ih_table.inverse_scale_factors,
+        Ih_table.Ih_values,
+        prefactor,
+        sigmaprime,
+    )
+
+
+def _calc_deltahl(
+    intensities, inverse_scale_factors, Ih_values, prefactor, sigmaprime, out=None
+):
+    delta_hl = np.divide(intensities, inverse_scale_factors, out=out)
+    delta_hl -= Ih_values
+    delta_hl *= prefactor
+    delta_hl /= sigmaprime
     return delta_hl
 
 
@@ -232,23 +263,75 @@ def __init__(self, Ih_table, min_reflections_required=250, n_bins=10):
         }
         self.n_bins = n_bins
         self.Ih_table = Ih_table
+        # The Ih_table data are fixed during minimisation, so keep contiguous
+        # arrays of the columns needed at each update, rather than looking
+        # them up in the Ih_table each time.
+        self.intensities = np.ascontiguousarray(Ih_table.intensities)
+        self.variances = np.ascontiguousarray(Ih_table.variances)
+        self.inverse_scale_factors = np.ascontiguousarray(
+            Ih_table.inverse_scale_factors
+        )
+        self.Ih_values = np.ascontiguousarray(Ih_table.Ih_values)
         self.min_reflections_required = min_reflections_required
         self.n_h = self.Ih_table.calc_nh()
-        self.sigmaprime = calc_sigmaprime([1.0, 0.0], self.Ih_table)
-        self.summation_matrix = self._create_summation_matrix()
+        self.deltahl_prefactor = calc_deltahl_prefactor(self.n_h)
+        self.sigmaprime = None
+        self.delta_hl = None
+        self._summation_matrix = None
+        self._create_bins()
         self.weights = np.array(self.binning_info["mean_intensities"])
-        self.delta_hl = calc_deltahl(self.Ih_table, self.n_h, self.sigmaprime)
-        self.bin_variances = self.calculate_bin_variances()
+        self.update([1.0, 0.0])
         self.binning_info["initial_variances"] = self.binning_info["bin_variances"]
 
     def update(self, parameters):
         """Update the variances for updated model parameters."""
-        self.sigmaprime = calc_sigmaprime(parameters, self.Ih_table)
-        self.delta_hl = calc_deltahl(self.Ih_table, self.n_h, self.sigmaprime)
+        # The sigmaprime and delta_hl arrays are overwritten in place.
+        self.sigmaprime = _calc_sigmaprime(
+            parameters,
+            self.variances,
+            self.intensities,
+            self.inverse_scale_factors,
+            out=self.sigmaprime,
+        )
+        self.delta_hl = _calc_deltahl(
+            self.intensities,
+            self.inverse_scale_factors,
+            self.Ih_values,
+            self.deltahl_prefactor,
+            self.sigmaprime,
+            out=self.delta_hl,
+        )
         self.bin_variances = self.calculate_bin_variances()
 
-    def _create_summation_matrix(self):
-        """Create a summation matrix to allow sums into intensity bins.
+    def clear_Ih_table(self):
+        """Delete the Ih_table and the cached data, to free memory."""
+        self.Ih_table = None
+        self.intensities = None
+        self.variances = None
+        self.inverse_scale_factors = None
+        self.Ih_values = None
+
+    @property
+    def summation_matrix(self):
+        """A sparse matrix to allow sums of per-reflection values into the bins.
+
+        The binner itself sums into bins using the bin index of each reflection,
+        so this is only constructed if requested."""
+        if self._summation_matrix is None:
+            rows = np.argsort(self._bin_index, kind="stable")
+            counts = np.bincount(self._bin_index, minlength=self._n_bins_used + 1)
+            rows_per_bin = np.split(rows, np.cumsum(counts)[:-1])[:-1]
+            self._summation_matrix = sparse.matrix(
+                self._bin_index.size,
+                self._n_bins_used,
+                elements_by_columns=[
+                    dict.fromkeys(bin_rows.tolist(), 1.0) for bin_rows in rows_per_bin
+                ],
+            )
+        return self._summation_matrix
+
+    def _create_bins(self):
+        """Assign each reflection to an intensity bin.
 
         This routine attempts to bin into bins equally spaced in log(intensity),
         to give a representative sample across all intensities. To avoid
@@ -256,103 +339,82 @@ def _create_summation_matrix(self):
         per intensity bin unless there are very few reflections."""
         n = self.Ih_table.size
         self.binning_info["n_reflections"] = n
-        summation_matrix = sparse.matrix(n, self.n_bins)
         # calculate expected intensity value in pixels on scale of each image
-        Ih = self.Ih_table.Ih_values * self.Ih_table.inverse_scale_factors
+        Ih = self.Ih_values * self.inverse_scale_factors
         if "partiality" in self.Ih_table.Ih_table:
             Ih *= self.Ih_table.Ih_table["partiality"].to_numpy()
-        size_order = flex.sort_permutation(flumpy.from_numpy(Ih), reverse=True)
-        Imax = Ih.max()
-        min_Ih = Ih.min()
+        # Sort by decreasing intensity, so that each bin is a contiguous slice
+        # of size_order, with limits that can be found by bisection.
+        size_order = np.argsort(Ih, kind="stable")[::-1]
+        sorted_Ih = Ih[size_order]
+        ascending_Ih = sorted_Ih[::-1]
+
+        def n_above(value):
+            return n - int(np.searchsorted(ascending_Ih, value, side="right"))
+
+        Imax = sorted_Ih[0]
+        min_Ih = sorted_Ih[-1]
         Imin = max(1.0, min_Ih)  # avoid log issues
         spacing = (log(Imax) - log(Imin)) / float(self.n_bins)
         boundaries = [Imax] + [
             exp(log(Imax) - (i * spacing)) for i in range(1, self.n_bins + 1)
         ]
         boundaries[-1] = min_Ih - 0.01
-        self.binning_info["bin_boundaries"] = np.array(boundaries)
-        self.binning_info["refl_per_bin"] = np.array([], dtype=float).reshape((0,))
 
-        n_cumul = 0
         if Ih.size > 100 * self.min_reflections_required:
             self.min_reflections_required = int(Ih.size / 100.0)
         min_per_bin = min(self.min_reflections_required, int(n / (3.0 * self.n_bins)))
-        for i in range(len(self.binning_info["bin_boundaries"]) - 1):
-            maximum = self.binning_info["bin_boundaries"][i]
-            minimum = self.binning_info["bin_boundaries"][i + 1]
-            sel1 = Ih <= maximum
-            sel2 = Ih > minimum
-            sel = sel1 & sel2
-            # isel = sel.iselection()
-            n_in_bin = np.count_nonzero(sel)  # isel.size()
+        refl_per_bin = []
+        n_cumul = 0
+        for i in range(self.n_bins):
+            n_in_bin = max(n_above(boundaries[i + 1]) - n_cumul, 0)
             if n_in_bin < min_per_bin:  # need more in this bin
                 m = n_cumul + min_per_bin
                 if m < n:  # still some refl left to use
-                    idx = size_order[m]
-                    intensity = Ih[idx]
-                    self.binning_info["bin_boundaries"][i + 1] = intensity
-                    minimum = self.binning_info["bin_boundaries"][i + 1]
-                    sel = sel1 & (Ih > minimum)
-                    # isel = sel.iselection()
-                    n_in_bin = np.count_nonzero(sel)  # isel.size()
-            self.binning_info["refl_per_bin"] = np.append(
-                self.binning_info["refl_per_bin"], [n_in_bin]
-            )
-            for j in np.nonzero(sel)[0]:  # isel:
-                summation_matrix[int(j), i] = 1
+                    boundaries[i + 1] = sorted_Ih[m]
+                    n_in_bin = max(n_above(boundaries[i + 1]) - n_cumul, 0)
+            refl_per_bin.append(n_in_bin)
             n_cumul += n_in_bin
-        cols_to_del = []
-        for i, col in enumerate(summation_matrix.cols()):
-            if col.non_zeroes < min_per_bin - 5:
-                cols_to_del.append(i)
-        n_new_cols = summation_matrix.n_cols - len(cols_to_del)
-        if n_new_cols == self.n_bins:
-            for i in range(len(self.binning_info["bin_boundaries"]) - 1):
-                maximum = self.binning_info["bin_boundaries"][i]
-                minimum = self.binning_info["bin_boundaries"][i + 1]
-                sel1 = Ih <= maximum
-                sel2 = Ih > minimum
-                sel = sel1 & sel2
-                self.binning_info["mean_intensities"] = np.append(
-                    self.binning_info["mean_intensities"], [np.mean(Ih[sel])]
-                )
-            return summation_matrix
-        new_sum_matrix = sparse.matrix(summation_matrix.n_rows, n_new_cols)
-        next_col = 0
-        refl_per_bin = np.array([], dtype=float).reshape((0,))
-        new_bounds = np.array([], dtype=float).reshape((0,))
-        for i, col in enumerate(summation_matrix.cols()):
-            if i not in cols_to_del:
-                new_sum_matrix[:, next_col] = col
-                next_col += 1
-                new_bounds = np.append(
-                    new_bounds, [self.binning_info["bin_boundaries"][i]]
-                )
-                refl_per_bin = np.append(
-                    refl_per_bin, [self.binning_info["refl_per_bin"][i]]
-                )
-        self.binning_info["refl_per_bin"] = refl_per_bin
-        new_bounds = np.append(new_bounds, [self.binning_info["bin_boundaries"][-1]])
+
+        # Only keep bins with a reasonable number of reflections.
+        bin_starts = np.cumsum([0] + refl_per_bin)
+        bins_to_keep = [
+            i for i, n_in_bin in enumerate(refl_per_bin) if n_in_bin >= min_per_bin - 5
+        ]
+        # Assign the bin index of each reflection in one pass over the sorted
+        # order. Reflections in discarded bins, or not in any bin, are assigned
+        # to an extra, final bin, which is ignored when summing.
+        bin_columns = np.full(self.n_bins, len(bins_to_keep), dtype=np.int64)
+        bin_columns[bins_to_keep] = np.arange(len(bins_to_keep))
+        self._n_bins_used = len(bins_to_keep)
+        self._bin_index = np.full(n, self._n_bins_used, dtype=np.int64)
+        self._bin_index[size_order[: bin_starts[-1]]] = np.repeat(
+            bin_columns, refl_per_bin
+        )
+        new_bounds = np.array([boundaries[i] for i in bins_to_keep] + [boundaries[-1]])
         self.binning_info["bin_boundaries"] = new_bounds
-        for i in range(len(new_bounds) - 1):
-            maximum = new_bounds[i]
-            minimum = new_bounds[i + 1]
-            sel1 = Ih <= maximum
-            sel2 = Ih > minimum
-            sel = sel1 & sel2
-            self.binning_info["mean_intensities"] = np.append(
-                self.binning_info["mean_intensities"], [np.mean(Ih[sel])]
-            )
-        return new_sum_matrix
+        self.binning_info["refl_per_bin"] = np.array(
+            [refl_per_bin[i] for i in bins_to_keep], dtype=float
+        )
+        self.binning_info["mean_intensities"] = np.array(
+            [
+                np.mean(sorted_Ih[n_above(new_bounds[i]) : n_above(new_bounds[i + 1])])
+                for i in range(len(bins_to_keep))
+            ]
+        )
+
+    def sum_in_bins(self, array) -> np.array:
+        """Sum a per-reflection array within each intensity bin."""
+        # The number of bins is fixed once the binning is done, so the output
+        # size is known and the overflow bin is always the last element.
+        return np.bincount(
+            self._bin_index, weights=array, minlength=self._n_bins_used + 1
+        )[:-1]
 
     def calculate_bin_variances(self) -> np.array:
         """Calculate the variance of each bin."""
-        sum_deltasq = flumpy.to_numpy(
-            flumpy.from_numpy(np.square(self.delta_hl)) * self.summation_matrix
-        )
-        sum_delta_sq = np.square(
-            flumpy.to_numpy(flumpy.from_numpy(self.delta_hl) * self.summation_matrix)
-        )
+        sum_deltasq = self.sum_in_bins(np.square(self.delta_hl))
+        sum_delta_sq = np.square(self.sum_in_bins(self.delta_hl))
         bin_vars = (sum_deltasq / self.binning_info["refl_per_bin"]) - (
             sum_delta_sq / np.square(self.binning_info["refl_per_bin"])
         )
@@ -398,6 +460,7 @@ def __init__(self, a=None, b=None, basic_params=None):
         self.free_components = []
         self.sortedy = None
         self.sortedx = None
+        self._sortedx_n = None
         self.binner = None
         if not basic_params:
             basic_params = phil_scope.fetch().extract().basic
@@ -437,11 +500,10 @@ def configure_for_refinement(
         self.binner = ErrorModelBinner(
             self.filtered_Ih_table, self.min_reflections_required, self.params.n_bins
         )
+        self.binner.update(self.parameters)
         # need to calculate sorted deltahl for norm dev plotting (and used by
         # individual a-parameter minimiser)
-        self.calculate_sorted_deviations(self.parameters)
-
-        self.binner.update(self.parameters)
+        self._sort_deviations(self.binner.delta_hl)
 
     @property
     def active_parameters(self):
@@ -463,7 +525,9 @@ def parameters(self, parameters):
 
     def finalise(self):
         """Perform any actions after minimisation finished."""
-        logger.info(self.binned_variances_summary())
+        # Only build the summary table if it will actually be logged.
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(self.binned_variances_summary())
 
     @property
     def n_refl(self):
@@ -493,10 +557,25 @@ def filter_unsuitable_reflections(
 
     def calculate_sorted_deviations(self, parameters):
         """Sort the x,y data."""
-        sigmaprime = calc_sigmaprime(parameters, self.filtered_Ih_table)
-        delta_hl = calc_deltahl(
-            self.filtered_Ih_table, self.filtered_Ih_table.calc_nh(), sigmaprime
+        # The binner holds the data and n_h prefactor for the filtered_Ih_table,
+        # so use these rather than recalculating n_h on each update.
+        sigmaprime = _calc_sigmaprime(
+            parameters,
+            self.binner.variances,
+            self.binner.intensities,
+            self.binner.inverse_scale_factors,
+        )
+        delta_hl = _calc_deltahl(
+            self.binner.intensities,
+            self.binner.inverse_scale_factors,
+            self.binner.Ih_values,
+            self.binner.deltahl_prefactor,
+            sigmaprime,
         )
+        self._sort_deviations(delta_hl)
+
+    def _sort_deviations(self, delta_hl):
+        """Sort the normalised deviations and select the central range."""
         central_cutoff = 1.5
         n = delta_hl.size
         self.sortedy = np.sort(delta_hl)
@@ -508,34 +587,45 @@ def calculate_sorted_deviations(self, parameters):
         idx_cutoff_max = ceil(
             (v2 * n) - 0.5
         )  # first one above the central cutoff range
-        central_n = idx_cutoff_max - idx_cutoff_min
-        v = np.linspace(
-            start=(idx_cutoff_min + 0.5) / n,
-            stop=(idx_cutoff_max + 0.5) / n,
-            endpoint=False,
-            num=central_n,
-        )
-
-        self.sortedx = flumpy.from_numpy(norm.ppf(v))
+        # The expected normal quantiles only depend on n, so only need to be
+        # calculated once rather than at every update of the parameters.
+        if self.sortedx is None or self._sortedx_n != n:
+            central_n = idx_cutoff_max - idx_cutoff_min
+            v = np.linspace(
+                start=(idx_cutoff_min + 0.5) / n,
+                stop=(idx_cutoff_max + 0.5) / n,
+                endpoint=False,
+                num=central_n,
+            )
+            self.sortedx = flumpy.from_numpy(norm.ppf(v))
+            self._sortedx_n = n
         self.sortedy = flumpy.from_numpy(self.sortedy[idx_cutoff_min:idx_cutoff_max])
 
     def update(self, parameters):
         """Update the model with new parameters."""
         self.parameters = parameters
         self.binner.update(parameters)
-        self.calculate_sorted_deviations(parameters)
-
-    def update_variances(self, variances, intensities):
-        """Use the error model parameter to calculate new values for the variances."""
-        new_variance = (self.parameters[0] ** 2) * (
-            variances + np.square(self.parameters[1] * intensities)
-        )
+        # The binner has just calculated delta_hl for these parameters
+        self._sort_deviations(self.binner.delta_hl)
+
+    def update_variances(self, variances, intensities, out=None):
+        """Use the error model parameter to calculate new values for the variances.
+
+        If an output array is given, the new variances are written into it. This
+        may be one of the input arrays."""
+        a, b = self.parameters
+        # Calculate (bI)^2 into a scratch array first, so that the inputs are
+        # fully read before anything is written to out
+        bI_sq = b * intensities
+        np.square(bI_sq, out=bI_sq)
+        new_variance = np.add(variances, bI_sq, out=out)
+        new_variance *= a**2
         return new_variance
 
     def clear_Ih_table(self):
         """Delete the Ih_table, to free memory."""
         if self.binner:
-            self.binner.Ih_table = None
+            self.binner.clear_Ih_table()
 
     def __str__(self):
         a = abs(self.parameters[0])
@@ -607,17 +697,15 @@ def filter_unsuitable_reflections_stills(
 ):
     """Filter suitable reflections for minimisation."""
 
-    if "partiality" in Ih_table.Ih_table:
-        sel = Ih_table.Ih_table["partiality"].to_numpy() > min_partiality
-        Ih_table = Ih_table.select(sel)
-
-    sel = (Ih_table.intensities / (Ih_table.variances**0.5)) >= min_Isigma
-    Ih_table = Ih_table.select(sel)
-
+    # The partiality, I/sigma and Ih filters only depend on each reflection's own
+    # values, so combine them into one mask to only need one selection.
+    sel = (Ih_table.intensities / np.sqrt(Ih_table.variances)) >= min_Isigma
     Ih = Ih_table.Ih_values * Ih_table.inverse_scale_factors
     if "partiality" in Ih_table.Ih_table:
-        Ih *= Ih_table.Ih_table["partiality"].to_numpy()
-    sel = Ih > min_Ih
+        partiality = Ih_table.Ih_table["partiality"].to_numpy()
+        sel &= partiality > min_partiality
+        Ih *= partiality
+    sel &= Ih > min_Ih
     Ih_table = Ih_table.select(sel)
 
     n_h = Ih_table.calc_nh()
@@ -653,9 +741,8 @@ def filter_unsuitable_reflections(
         sel = Ih_table.Ih_table["partiality"].to_numpy() > min_partiality
         Ih_table = Ih_table.select(sel)
 
-    n = Ih_table.size
     sum_I_over_var = Ih_table.sum_in_groups(Ih_table.intensities / Ih_table.variances)
-    n_per_group = Ih_table.sum_in_groups(np.full(n, 1))
+    n_per_group = Ih_table.group_multiplicities()
     avg_I_over_var = sum_I_over_var / n_per_group
     sel = avg_I_over_var > 0.85
     Ih_table = Ih_table.select_on_groups(sel)
@@ -663,14 +750,14 @@ def filter_unsuitable_reflections(
     scaled_Ih = Ih_table.Ih_values * Ih_table.inverse_scale_factors
     # need a scaled min_Ih, where can reasonably expect norm distribution
     # (use min_Ih=25 by default, sigma ~ 5)
-    sel2 = scaled_Ih > min_Ih
+    sel = scaled_Ih > min_Ih
     # can't calculate a true deviation for groups of 1
-    sel3 = n_h > 1.0
-    sel4 = Ih_table.intensities > 0.001
+    sel &= n_h > 1.0
+    sel &= Ih_table.intensities > 0.001
     # don't want to include weaker reflections where the background adds
     # significantly to the variances, as these would no longer be normally
     # distributed and skew the fit.
-    Ih_table = Ih_table.select(sel2 & sel3 & sel4)
+    Ih_table = Ih_table.select(sel)
     n = Ih_table.size
     if n < min_reflections_required:
         raise ValueError(
@@ -691,7 +778,7 @@ def filter_unsuitable_reflections(
     I = Ih_table.intensities
     mu = Ih_table.Ih_values
     g = Ih_table.inverse_scale_factors
-    n_h = Ih_table.sum_in_groups(np.full(Ih_table.size, 1.0))
+    n_h = Ih_table.group_multiplicities()
 
     group_variances = Ih_table.sum_in_groups(((I / g) - mu) ** 2) / (
         n_h - np.full(n_h.size, 1.0)
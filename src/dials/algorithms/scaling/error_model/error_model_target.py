@@ -164,34 +164,23 @@ def calculate_gradients(self, apm):
         "calculate the gradient vector"
         a = self.error_model.components["a"].parameters[0]
         b = apm.x[0]
-        Ih_table = self.error_model.binner.Ih_table
-        I_hl = Ih_table.intensities
-        g_hl = Ih_table.inverse_scale_factors
-        weights = self.error_model.binner.weights
-        bin_vars = self.error_model.binner.bin_variances
-        sum_matrix = self.error_model.binner.summation_matrix
-        bin_counts = self.error_model.binner.binning_info["refl_per_bin"]
-        dsig_dc = (
-            b
-            * np.square(I_hl)
-            * (a**2)
-            / (self.error_model.binner.sigmaprime * np.square(g_hl))
-        )
-        ddelta_dsigma = (
-            -1.0 * self.error_model.binner.delta_hl / self.error_model.binner.sigmaprime
-        )
-        deriv = ddelta_dsigma * dsig_dc
+        binner = self.error_model.binner
+        weights = binner.weights
+        bin_vars = binner.bin_variances
+        bin_counts = binner.binning_info["refl_per_bin"]
+        # d(delta_hl)/dsigma * dsigma/db = -delta_hl * a^2 * b * (I/g)^2 / sigma^2,
+        # evaluated in place to limit the number of temporary arrays.
+        deriv = np.divide(binner.intensities, binner.inverse_scale_factors)
+        deriv /= binner.sigmaprime
+        np.square(deriv, out=deriv)
+        deriv *= binner.delta_hl
+        deriv *= -1.0 * b * (a**2)
         dphi_by_dvar = -2.0 * (
             np.full(bin_vars.size, 0.5) - bin_vars + (1.0 / (2.0 * np.square(bin_vars)))
         )
-        term1 = flumpy.to_numpy(
-            flumpy.from_numpy(2.0 * self.error_model.binner.delta_hl * deriv)
-            * sum_matrix
-        )
-        term2a = flumpy.to_numpy(
-            flumpy.from_numpy(self.error_model.binner.delta_hl) * sum_matrix
-        )
-        term2b = flumpy.to_numpy(flumpy.from_numpy(deriv) * sum_matrix)
+        term1 = 2.0 * binner.sum_in_bins(binner.delta_hl * deriv)
+        term2a = binner.sum_in_bins(binner.delta_hl)
+        term2b = binner.sum_in_bins(deriv)
         grad = dphi_by_dvar * (
             (term1 / bin_counts) - (2.0 * term2a * term2b / np.square(bin_counts))
         )
@@ -216,8 +216,8 @@ def prepare_reflection_tables_for_output(self):
             if scaler._experiment.scaling_model.error_model:
                 scaler.reflection_table["variance"] = flumpy.from_numpy(
                     scaler._experiment.scaling_model.error_model.update_variances(
-                        scaler.reflection_table["variance"],
-                        scaler.reflection_table["intensity"],
+                        flumpy.to_numpy(scaler.reflection_table["variance"]),
+                        flumpy.to_numpy(scaler.reflection_table["intensity"]),
                     )
                 )
             # now increase the errors slightly to take into account the uncertainty in the
@@ -695,6 +695,29 @@ namespace dials { namespace af { namespace boost_python {
     return result;
   }
 
+  /**
+   * Get the mean of the background model over all pixels. Unlike
+   * mean_modelled_background, this ignores the BackgroundUsed mask. An empty
+   * shoebox gives 0 rather than raising, as flex.mean would.
+   */
+  template <typename FloatType>
+  af::shared<double> mean_background_model_all_pixels(
+    const const_ref<Shoebox<FloatType> > &a) {
+    af::shared<double> result(a.size());
+    for (std::size_t i = 0; i < result.size(); ++i) {
+      af::versa<FloatType, af::c_grid<3> > data = a[i].background;
+      double mean = 0.0;
+      for (std::size_t j = 0; j < data.size(); ++j) {
+        mean += data[j];
+      }
+      if (data.size() > 0) {
+        mean /= data.size();
+      }
+      result[i] = mean;
+    }
+    return result;
+  }
+
   /**
    * Flatten the shoeboxes
    */
@@ -1047,6 +1070,8 @@ namespace dials { namespace af { namespace boost_python {
         .def("summed_intensity", &summed_intensity<FloatType>)
         .def("mean_background", &mean_background<FloatType>)
         .def("mean_modelled_background", &mean_modelled_background<FloatType>)
+        .def("mean_background_model_all_pixels",
+             &mean_background_model_all_pixels<FloatType>)
         .def("flatten", &flatten<FloatType>)
         .def("apply_background_mask", &apply_background_mask<FloatType>)
         .def("apply_pixel_data", &apply_pixel_data<FloatType>)
@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import cmath
 import concurrent.futures
 import copy
 import itertools
@@ -8,8 +7,11 @@
 import math
 import random
 
+import numpy as np
+
 import iotbx.phil
 import libtbx
+from dxtbx.model.experiment_list import ExperimentList
 from libtbx.test_utils import approx_equal
 from libtbx.utils import plural_s
 from rstbx.dps_core import Direction, Directional_FFT
@@ -84,6 +86,9 @@
 """
 )
 
+# The DPS indexing parameters only need parsing once
+horizon_phil_scope = iotbx.phil.parse(input_string=indexing_api_defs)
+
 
 def optimize_origin_offset_local_scope(
     experiments,
@@ -93,9 +98,11 @@ def optimize_origin_offset_local_scope(
     mm_search_scope=4,
     wide_search_binning=1,
     plot_search_scope=False,
+    nproc=1,
 ):
     """Local scope: find the optimal origin-offset closest to the current overall detector position
-    (local minimum, simple minimization)"""
+    (local minimum, simple minimization). Returns the experiments with the offset applied, and
+    the offset."""
 
     beam = experiments[0].beam
     s0 = matrix.col(beam.get_s0())
@@ -110,30 +117,44 @@ def optimize_origin_offset_local_scope(
     assert approx_equal(beamr2.dot(beamr1), 0.0)
     # so the orthonormal vectors are s0, beamr1 and beamr2
 
+    assert (
+        len(experiments)
+        == len(reflection_lists)
+        == len(solution_lists)
+        == len(amax_lists)
+    )
+
+    # Gather the per-experiment scoring inputs once. The Directions are built
+    # from the solutions in whichever process does the scoring.
+    experiment_data = [
+        (_OriginOffsetRlpCalculator(experiment, spots_mm), solutions, amax)
+        for experiment, spots_mm, solutions, amax in zip(
+            experiments, reflection_lists, solution_lists, amax_lists
+        )
+    ]
+    scoring_data = _get_scoring_data(experiment_data)
+
     if mm_search_scope:
         plot_px_sz = experiments[0].detector[0].get_pixel_size()[0]
         plot_px_sz *= wide_search_binning
         grid = max(1, int(mm_search_scope / plot_px_sz))
         widegrid = 2 * grid + 1
 
-        def get_experiment_score_for_coord(x, y):
-            new_origin_offset = x * plot_px_sz * beamr1 + y * plot_px_sz * beamr2
-            return sum(
-                _get_origin_offset_score(
-                    new_origin_offset,
-                    solution_lists[i],
-                    amax_lists[i],
-                    reflection_lists[i],
-                    experiment,
-                )
-                for i, experiment in enumerate(experiments)
-            )
-
-        scores = flex.double(
-            get_experiment_score_for_coord(x, y)
+        step1 = plot_px_sz * beamr1
+        step2 = plot_px_sz * beamr2
+        trial_offsets = [
+            x * step1 + y * step2
             for y in range(-grid, grid + 1)
             for x in range(-grid, grid + 1)
-        )
+        ]
+        if nproc > 1:
+            scores = flex.double(
+                _score_origin_offsets(trial_offsets, experiment_data, nproc)
+            )
+        else:
+            scores = flex.double(
+                _score_origin_offset(offset, scoring_data) for offset in trial_offsets
+            )
 
         def igrid(x):
             return x - (widegrid // 2)
@@ -142,22 +163,27 @@ def igrid(x):
 
         # if there are several similarly high scores, then choose the closest
         # one to the current beam centre
-        potential_offsets = flex.vec3_double()
         if scores.all_eq(0):
             raise Sorry("No valid scores")
         sel = scores > (0.9 * flex.max(scores))
-        for i in sel.iselection():
-            offset = (idxs[i % widegrid]) * beamr1 + (idxs[i // widegrid]) * beamr2
-            potential_offsets.append(offset.elems)
-            # print offset.length(), scores[i]
+        isel = sel.iselection().as_numpy_array()
+        idxs_np = np.array(idxs)
+        potential_offsets = np.outer(idxs_np[isel % widegrid], beamr1.elems) + np.outer(
+            idxs_np[isel // widegrid], beamr2.elems
+        )
         wide_search_offset = matrix.col(
-            potential_offsets[flex.min_index(potential_offsets.norms())]
+            potential_offsets[
+                np.einsum("ij,ij->i", potential_offsets, potential_offsets).argmin()
+            ].tolist()
         )
 
     else:
         wide_search_offset = None
 
     # Do a simplex minimization
+    simplex_step1 = 0.2 * beamr1
+    simplex_step2 = 0.2 * beamr2
+
     class simplex_minimizer:
         def __init__(self, wide_search_offset):
             self.n = 2
@@ -169,44 +195,30 @@ def __init__(self, wide_search_offset):
                 tolerance=1e-7,
             )
             self.x = self.optimizer.get_solution()
-            self.offset = self.x[0] * 0.2 * beamr1 + self.x[1] * 0.2 * beamr2
+            self.offset = self.x[0] * simplex_step1 + self.x[1] * simplex_step2
             if self.wide_search_offset is not None:
                 self.offset += self.wide_search_offset
 
         def target(self, vector):
-            trial_origin_offset = vector[0] * 0.2 * beamr1 + vector[1] * 0.2 * beamr2
+            trial_origin_offset = vector[0] * simplex_step1 + vector[1] * simplex_step2
             if self.wide_search_offset is not None:
                 trial_origin_offset += self.wide_search_offset
-            target = 0
-            for i, experiment in enumerate(experiments):
-                target -= _get_origin_offset_score(
-                    trial_origin_offset,
-                    solution_lists[i],
-                    amax_lists[i],
-                    reflection_lists[i],
-                    experiment,
-                )
-            return target
+            return -_score_origin_offset(trial_origin_offset, scoring_data)
 
     new_offset = simplex_minimizer(wide_search_offset).offset
 
     if plot_search_scope:
-        plot_px_sz = experiments[0].get_detector()[0].get_pixel_size()[0]
-        grid = max(1, int(mm_search_scope / plot_px_sz))
-        scores = flex.double()
-        for y in range(-grid, grid + 1):
-            for x in range(-grid, grid + 1):
-                new_origin_offset = x * plot_px_sz * beamr1 + y * plot_px_sz * beamr2
-                score = 0
-                for i, experiment in enumerate(experiments):
-                    score += _get_origin_offset_score(
-                        new_origin_offset,
-                        solution_lists[i],
-                        amax_lists[i],
-                        reflection_lists[i],
-                        experiment,
-                    )
-                scores.append(score)
+        # Plot the wide search scores if available, otherwise score a grid here
+        if not mm_search_scope:
+            plot_px_sz = experiments[0].get_detector()[0].get_pixel_size()[0]
+            grid = 1
+            scores = flex.double(
+                _score_origin_offset(
+                    x * plot_px_sz * beamr1 + y * plot_px_sz * beamr2, scoring_data
+                )
+                for y in range(-grid, grid + 1)
+                for x in range(-grid, grid + 1)
+            )
 
         def show_plot(widegrid, excursi):
             excursi.reshape(flex.grid(widegrid, widegrid))
@@ -248,70 +260,170 @@ def igrid(x):
 
         show_plot(widegrid=2 * grid + 1, excursi=scores)
 
-    new_experiments = copy.deepcopy(experiments)
-    for expt in new_experiments:
-        expt.detector = dps_extended.get_new_detector(expt.detector, new_offset)
-    return new_experiments
+    new_experiments = ExperimentList(
+        [_apply_origin_offset(expt, new_offset) for expt in experiments]
+    )
+    return new_experiments, new_offset
 
 
-def _get_origin_offset_score(
-    trial_origin_offset, solutions, amax, spots_mm, experiment
-):
-    trial_detector = dps_extended.get_new_detector(
-        experiment.detector, trial_origin_offset
-    )
+def _apply_origin_offset(experiment, origin_offset):
+    """Return a copy of the experiment with the detector origin offset applied."""
+    # Only the detector model is replaced, so the other models can be shared
     experiment = copy.copy(experiment)
-    experiment.detector = trial_detector
+    experiment.detector = dps_extended.get_new_detector(
+        experiment.detector, origin_offset
+    )
+    return experiment
+
+
+class _OriginOffsetRlpCalculator:
+    """Map spot centroids to reciprocal space for trial detector origin offsets.
+
+    A trial origin offset translates every detector panel, so the laboratory
+    coordinates of the spots are computed once and then shifted for each trial
+    offset. The spots must correspond to detector positions rather than to the
+    correct reciprocal space positions, so any fixed rotation is treated as the
+    identity.
+    """
+
+    def __init__(self, experiment, spots_mm):
+        x, y, z = spots_mm["xyzobs.mm.value"].parts()
+        panel_numbers = flex.size_t(spots_mm["panel"])
+        self._lab_coords = flex.vec3_double(len(spots_mm))
+        for i_panel, panel in enumerate(experiment.detector):
+            sel = panel_numbers == i_panel
+            self._lab_coords.set_selected(
+                sel,
+                panel.get_lab_coord(flex.vec2_double(x.select(sel), y.select(sel))),
+            )
+
+        if "wavelength" in spots_mm and "s0" in spots_mm:
+            self._inv_wavelength = 1 / spots_mm["wavelength"]
+            self._s0 = spots_mm["s0"]
+        else:
+            self._inv_wavelength = 1 / experiment.beam.get_wavelength()
+            self._s0 = experiment.beam.get_s0()
+
+        self._setting_rotation_inv = None
+        self._rotation_axis = None
+        if experiment.goniometer is not None:
+            self._setting_rotation_inv = tuple(
+                matrix.sqr(experiment.goniometer.get_setting_rotation()).inverse()
+            )
+            if experiment.scan is not None and experiment.scan.has_property(
+                "oscillation"
+            ):
+                self._rotation_axis = experiment.goniometer.get_rotation_axis_datum()
+                self._rotation_angles = -z
+
+    def rlp(self, trial_origin_offset):
+        """Return the reciprocal lattice points for the given origin offset."""
+        s1 = self._lab_coords + trial_origin_offset.elems
+        s1 = s1 / s1.norms() * self._inv_wavelength
+        rlp = s1 - self._s0
+        if self._setting_rotation_inv is not None:
+            rlp = self._setting_rotation_inv * rlp
+            if self._rotation_axis is not None:
+                rlp = rlp.rotate_around_origin(
+                    self._rotation_axis, self._rotation_angles
+                )
+        return rlp
+
+
+def _get_scoring_data(experiment_data):
+    """Replace the DPS solutions of each experiment with their Directions."""
+    return [
+        (rlp_calculator, _get_directions(solutions), amax)
+        for rlp_calculator, solutions, amax in experiment_data
+    ]
+
+
+def _score_origin_offset(trial_origin_offset, scoring_data):
+    """Return the score for a trial origin offset, summed over all experiments."""
+    return sum(
+        _sum_score_detail(
+            rlp_calculator.rlp(trial_origin_offset), directions, amax=amax
+        )
+        for rlp_calculator, directions, amax in scoring_data
+    )
+
+
+def _score_origin_offsets(trial_offsets, experiment_data, nproc):
+    """Score the trial origin offsets in chunks over a pool of nproc processes."""
+    chunk_size = max(1, len(trial_offsets) // (4 * nproc))
+    chunks = [
+        trial_offsets[i : i + chunk_size]
+        for i in range(0, len(trial_offsets), chunk_size)
+    ]
+    # Send the experiment data to each worker once, rather than with every chunk
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(nproc, len(chunks)),
+        initializer=_init_scoring_worker,
+        initargs=(experiment_data,),
+    ) as pool:
+        return list(
+            itertools.chain.from_iterable(pool.map(_score_origin_offsets_chunk, chunks))
+        )
+
+
+# The scoring data of a worker process, set up by _init_scoring_worker
+_worker_scoring_data = None
 
-    # Key point for this is that the spots must correspond to detector
-    # positions not to the correct RS position => reset any fixed rotation
-    # to identity
 
-    experiment.goniometer.set_fixed_rotation((1, 0, 0, 0, 1, 0, 0, 0, 1))
-    spots_mm.map_centroids_to_reciprocal_space([experiment])
-    return _sum_score_detail(spots_mm["rlp"], solutions, amax=amax)
+def _init_scoring_worker(experiment_data):
+    global _worker_scoring_data
+    _worker_scoring_data = _get_scoring_data(experiment_data)
 
 
-def _sum_score_detail(reciprocal_space_vectors, solutions, granularity=None, amax=None):
+def _score_origin_offsets_chunk(trial_offsets):
+    return [
+        _score_origin_offset(offset, _worker_scoring_data) for offset in trial_offsets
+    ]
+
+
+def _get_directions(solutions):
+    """Return the Direction for each of the (at most 20) leading DPS solutions."""
+    nh = min(solutions.size(), 20)  # extended API
+    return [Direction(solutions[t]) for t in range(nh)]
+
+
+def _sum_score_detail(reciprocal_space_vectors, directions, amax=None):
     """Evaluates the probability that the trial value of (S0_vector | origin_offset) is correct,
     given the current estimate and the observations.  The trial value comes through the
     reciprocal space vectors, and the current estimate comes through the short list of
-    DPS solutions. Actual return value is a sum of NH terms, one for each DPS solution, each ranging
-    from -1.0 to 1.0"""
+    DPS solutions, given as a list of Directions. Actual return value is a sum of NH terms, one
+    for each DPS solution, each ranging from -1.0 to 1.0"""
 
-    nh = min(solutions.size(), 20)  # extended API
-    sum_score = 0.0
-    for t in range(nh):
+    kval_cutoff = reciprocal_space_vectors.size() / 4.0
+    fft_peaks = []
+    phase_shifts = []
+    for direction in directions:
         dfft = Directional_FFT(
-            angle=Direction(solutions[t]),
+            angle=direction,
             xyzdata=reciprocal_space_vectors,
             granularity=5.0,
             amax=amax,  # extended API XXX These values have to come from somewhere!
             F0_cutoff=11,
         )
-        kval = dfft.kval()
-        kmax = dfft.kmax()
-        kval_cutoff = reciprocal_space_vectors.size() / 4.0
-        if kval > kval_cutoff:
+        if dfft.kval() > kval_cutoff:
             ff = dfft.fft_result
+            kmax = dfft.kmax()
             kbeam = ((-dfft.pmin) / dfft.delta_p) + 0.5
-            Tkmax = cmath.phase(ff[kmax])
-            backmax = math.cos(
-                Tkmax + (2 * math.pi * kmax * kbeam / (2 * ff.size() - 1))
-            )
-            ### Here it should be possible to calculate a gradient.
-            ### Then minimize with respect to two coordinates.  Use lbfgs?  Have second derivatives?
-            ### can I do something local to model the cosine wave?
-            ### direction of wave travel.  Period. phase.
-            sum_score += backmax
-    return sum_score
+            fft_peaks.append(ff[kmax])
+            phase_shifts.append(2 * math.pi * kmax * kbeam / (2 * ff.size() - 1))
+    ### Here it should be possible to calculate a gradient.
+    ### Then minimize with respect to two coordinates.  Use lbfgs?  Have second derivatives?
+    ### can I do something local to model the cosine wave?
+    ### direction of wave travel.  Period. phase.
+    backmax = np.cos(np.angle(fft_peaks) + np.array(phase_shifts))
+    return float(backmax.sum())
 
 
 def run_dps(experiment, spots_mm, max_cell):
     # max_cell: max possible cell in Angstroms; set to None, determine from data
     # recommended_grid_sampling_rad: grid sampling in radians; guess for now
 
-    horizon_phil = iotbx.phil.parse(input_string=indexing_api_defs).extract()
+    horizon_phil = horizon_phil_scope.extract()
     DPS = DPS_primitive_lattice(
         max_cell=max_cell, recommended_grid_sampling_rad=None, horizon_phil=horizon_phil
     )
@@ -326,21 +438,14 @@ def run_dps(experiment, spots_mm, max_cell):
 
     # transform input into what DPS needs
     # i.e., construct a flex.vec3 double consisting of mm spots, phi in degrees
-    data = flex.vec3_double()
-    for spot in spots_mm.rows():
-        data.append(
-            (
-                spot["xyzobs.mm.value"][0],
-                spot["xyzobs.mm.value"][1],
-                spot["xyzobs.mm.value"][2] * 180.0 / math.pi,
-            )
-        )
+    x, y, z = spots_mm["xyzobs.mm.value"].parts()
+    data = flex.vec3_double(x, y, z * 180.0 / math.pi)
 
     logger.info("Running DPS using %i reflections", len(data))
 
     DPS.index(
         raw_spot_input=data,
-        panel_addresses=flex.int(s["panel"] for s in spots_mm.rows()),
+        panel_addresses=flex.int(spots_mm["panel"]),
     )
     solutions = DPS.getSolutions()
 
@@ -404,8 +509,7 @@ def discover_better_experimental_model(
                 "Selecting subset of %i reflections for analysis",
                 params.max_reflections,
             )
-            perm = flex.random_permutation(refl.size())
-            sel = perm[: params.max_reflections]
+            sel = flex.random_selection(refl.size(), params.max_reflections)
             refl = refl.select(sel)
 
         refl_lists.append(refl)
@@ -415,28 +519,48 @@ def discover_better_experimental_model(
     else:
         max_cell = params.max_cell
 
+    # run_dps only needs the spot centroids and panels, so avoid pickling the
+    # full reflection tables to send to the worker processes
+    dps_spots = [refl.select(("xyzobs.mm.value", "panel")) for refl in refl_lists]
+
     with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as pool:
-        solution_lists = []
-        amax_list = []
-        for result in pool.map(
-            run_dps, experiments, refl_lists, itertools.repeat(max_cell)
-        ):
-            if result.get("solutions"):
-                solution_lists.append(result["solutions"])
-                amax_list.append(result["amax"])
-
-    if not solution_lists:
+        futures = {
+            pool.submit(run_dps, expt, spots_mm, max_cell): i
+            for i, (expt, spots_mm) in enumerate(zip(experiments, dps_spots))
+        }
+        results = [None] * len(futures)
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+
+    # Only experiments with DPS solutions can be used to score origin offsets
+    scored = [i for i, result in enumerate(results) if result.get("solutions")]
+    if not scored:
         raise Sorry("No solutions found")
-
-    new_experiments = optimize_origin_offset_local_scope(
-        experiments,
-        refl_lists,
-        solution_lists,
-        amax_list,
+    for i in sorted(set(range(len(experiments))) - set(scored)):
+        logger.warning("No DPS solutions for experiment %i, so not using it", i)
+
+    optimised_experiments, new_offset = optimize_origin_offset_local_scope(
+        ExperimentList([experiments[i] for i in scored]),
+        [refl_lists[i] for i in scored],
+        [results[i]["solutions"] for i in scored],
+        [results[i]["amax"] for i in scored],
         mm_search_scope=mm_search_scope,
         wide_search_binning=wide_search_binning,
         plot_search_scope=plot_search_scope,
+        nproc=nproc,
     )
+
+    # Apply the same origin offset to any experiments without solutions
+    optimised_by_index = dict(zip(scored, optimised_experiments))
+    new_experiments = ExperimentList(
+        [
+            optimised_by_index[i]
+            if i in optimised_by_index
+            else _apply_origin_offset(expt, new_offset)
+            for i, expt in enumerate(experiments)
+        ]
+    )
+
     new_detector = new_experiments[0].detector
     old_panel, old_beam_centre = detector.get_ray_intersection(beam.get_s0())
     new_panel, new_beam_centre = new_detector.get_ray_intersection(beam.get_s0())
@@ -204,6 +204,7 @@ def test_IhTableblock_onedataset(large_reflection_table, test_sg):
         )
 
     assert list(block.calc_nh()) == [2, 1, 2, 1, 1, 2, 2]
+    assert list(block.group_multiplicities()) == [2, 1, 1, 1, 2]
 
     # Test update error model
     block.update_weights(mock_error_model())
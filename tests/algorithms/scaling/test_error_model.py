@@ -17,6 +17,7 @@
     BasicErrorModel,
     ErrorModelB_APM,
     calc_deltahl,
+    calc_deltahl_prefactor,
     calc_sigmaprime,
 )
 from dials.algorithms.scaling.error_model.error_model_target import ErrorModelTargetB
@@ -208,6 +209,15 @@ def test_errormodel(large_reflection_table, test_sg, use_stills_filtering):
     assert error_model.binner.summation_matrix[4, 0] == 1
     assert error_model.binner.summation_matrix.non_zeroes == 5
     assert list(error_model.binner.binning_info["refl_per_bin"]) == [3, 2]
+    assert list(error_model.binner.sum_in_bins(np.full(5, 1.0))) == [3, 2]
+    assert list(
+        error_model.binner.sum_in_bins(np.array([1.0, 2.0, 3.0, 4.0, 5.0]))
+    ) == [12.0, 3.0]
+    # The bin variances are the (double precision) variances of delta_hl in each bin
+    delta_hl = error_model.binner.delta_hl
+    assert list(error_model.binner.bin_variances) == pytest.approx(
+        [np.var(delta_hl[[2, 3, 4]]), np.var(delta_hl[[0, 1]])], rel=1e-9
+    )
 
     # Test calc sigmaprime
     x0 = 1.0
@@ -238,6 +248,12 @@ def test_errormodel(large_reflection_table, test_sg, use_stills_filtering):
         0.124783549621,
     ]
     assert list(delta_hl) == pytest.approx(expected_deltas)
+    # Using a precomputed prefactor should give the same result
+    n_h = error_model.filtered_Ih_table.calc_nh()
+    delta_hl = calc_deltahl(
+        error_model.filtered_Ih_table, n_h, sigmaprime, calc_deltahl_prefactor(n_h)
+    )
+    assert list(delta_hl) == pytest.approx(expected_deltas)
 
 
 def test_error_model_target(large_reflection_table, test_sg):
@@ -265,6 +281,12 @@ def test_error_model_target(large_reflection_table, test_sg):
     _, g = target.compute_functional_gradients(parameterisation)
     assert list(gradients) == pytest.approx(list(g))
 
+    # The sorted deviations from an update match a full recalculation
+    error_model.update([1.0, 0.05])
+    sortedy = list(error_model.sortedy)
+    error_model.calculate_sorted_deviations([1.0, 0.05])
+    assert sortedy == pytest.approx(list(error_model.sortedy))
+
 
 def calculate_gradient_fd(target, parameterisation):
     """Calculate gradient array with finite difference approach."""
@@ -279,3 +301,29 @@ def calculate_gradient_fd(target, parameterisation):
     target.predict(parameterisation)
     gradients = [(flex.sum(R_upper) - flex.sum(R_low)) / delta]
     return gradients
+
+
+def test_update_variances():
+    """Test the calculation of updated variances, including writing in-place."""
+    error_model = BasicErrorModel(a=1.5, b=0.1)
+    variances = np.array([1.0, 4.0, 10.0])
+    intensities = np.array([10.0, 20.0, 100.0])
+    expected = [2.25 * (v + (0.1 * i) ** 2) for v, i in zip(variances, intensities)]
+    assert list(error_model.update_variances(variances, intensities)) == (
+        pytest.approx(expected)
+    )
+    out = np.empty(3)
+    result = error_model.update_variances(variances, intensities, out=out)
+    assert result is out
+    assert list(out) == pytest.approx(expected)
+    # the input arrays should not be modified
+    assert list(variances) == [1.0, 4.0, 10.0]
+    assert list(intensities) == [10.0, 20.0, 100.0]
+    # writing over either input array gives the same result
+    result = error_model.update_variances(variances, intensities, out=variances)
+    assert result is variances
+    assert list(variances) == pytest.approx(expected)
+    variances = np.array([1.0, 4.0, 10.0])
+    result = error_model.update_variances(variances, intensities, out=intensities)
+    assert result is intensities
+    assert list(intensities) == pytest.approx(expected)
@@ -2,6 +2,8 @@
 
 import random
 
+import pytest
+
 
 def test_consistent():
     from dials.array_family import flex
@@ -139,3 +141,30 @@ def test_bounding_boxes():
     bbox2 = shoebox.bounding_boxes()
     for i in range(10):
         assert bbox2[i] == bbox[i]
+
+
+def test_mean_background_model_all_pixels():
+    from dials.array_family import flex
+    from dials.model.data import Shoebox
+
+    shoebox = flex.shoebox(10)
+    expected = flex.double(10)
+    for i in range(10):
+        x0 = random.randint(0, 90)
+        y0 = random.randint(0, 90)
+        z0 = random.randint(0, 90)
+        x1 = random.randint(1, 10) + x0
+        y1 = random.randint(1, 10) + y0
+        z1 = random.randint(1, 10) + z0
+        shoebox[i] = Shoebox((x0, x1, y0, y1, z0, z1))
+        shoebox[i].allocate()
+        for j in range(len(shoebox[i].background)):
+            shoebox[i].background[j] = random.uniform(0, 10)
+        expected[i] = flex.mean(shoebox[i].background)
+
+    assert list(shoebox.mean_background_model_all_pixels()) == pytest.approx(
+        list(expected)
+    )
+
+    # An empty shoebox has a mean background of zero
+    assert list(flex.shoebox(1).mean_background_model_all_pixels()) == [0.0]
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import concurrent.futures
 import os
 from pathlib import Path
 
@@ -9,6 +10,7 @@
 from cctbx import uctbx
 from dxtbx.serialize import load
 
+from dials.array_family import flex
 from dials.command_line import search_beam_position
 
 from ..algorithms.indexing.test_index import run_indexing
@@ -86,6 +88,53 @@ def test_search_multiple(run_in_tmp_path, dials_regression: Path):
     assert shift.elems == pytest.approx((-0.518, 0.192, 0.0), abs=1e-1)
 
 
+def test_search_experiment_without_solutions(
+    mocker, run_in_tmp_path, dials_regression: Path
+):
+    """Experiments without DPS solutions get the offset found from the others."""
+    data_dir = os.path.join(dials_regression, "indexing_test_data", "trypsin")
+    experiments_path1 = os.path.join(data_dir, "experiments_P1_X6_1.json")
+    experiments_path2 = os.path.join(data_dir, "experiments_P1_X6_2.json")
+    args = [
+        experiments_path1,
+        experiments_path2,
+        os.path.join(data_dir, "strong_P1_X6_1_0-1.pickle"),
+        os.path.join(data_dir, "strong_P1_X6_2_0-1.pickle"),
+        "nproc=1",
+    ]
+
+    # Run DPS in this process, so that the second experiment has no solutions
+    mocker.patch(
+        "concurrent.futures.ProcessPoolExecutor", concurrent.futures.ThreadPoolExecutor
+    )
+    run_dps = search_beam_position.run_dps
+
+    def run_dps_without_second_solutions(experiment, spots_mm, max_cell):
+        if mock_run_dps.call_count > 1:
+            return {}
+        return run_dps(experiment, spots_mm, max_cell)
+
+    mock_run_dps = mocker.patch.object(
+        search_beam_position, "run_dps", side_effect=run_dps_without_second_solutions
+    )
+    search_beam_position.run(args)
+    assert mock_run_dps.call_count == 2
+
+    experiments = [
+        load.experiment_list(path, check_format=False)[0]
+        for path in (experiments_path1, experiments_path2)
+    ]
+    optimised_experiments = load.experiment_list("optimised.expt", check_format=False)
+    assert len(optimised_experiments) == 2
+    shifts = [
+        scitbx.matrix.col(new_expt.detector[0].get_origin())
+        - scitbx.matrix.col(old_expt.detector[0].get_origin())
+        for old_expt, new_expt in zip(experiments, optimised_experiments)
+    ]
+    assert shifts[0].length() > 0
+    assert shifts[1].elems == pytest.approx(shifts[0].elems)
+
+
 def test_index_after_search(dials_data, run_in_tmp_path):
     """Integrate the beam centre search with the rest of the toolchain
 
@@ -225,3 +274,62 @@ def test_multi_sweep_fixed_rotation(dials_data, run_in_tmp_path):
         ) - scitbx.matrix.col(new_expt.detector[0].get_origin())
         print(shift)
         assert shift.elems == pytest.approx((0.096, -1.111, 0), abs=1e-2)
+
+
+def test_origin_offset_rlp_calculator(dials_data):
+    """Check the precomputed mapping against rebuilding the detector model."""
+    from rstbx.indexing_api import dps_extended
+
+    insulin = dials_data("insulin_processed", pathlib=True)
+    experiments = load.experiment_list(insulin / "imported.expt", check_format=False)
+    reflections = flex.reflection_table.from_file(insulin / "strong.refl")
+    reflections["imageset_id"] = flex.int(len(reflections), 0)
+    reflections.centroid_px_to_mm(experiments)
+
+    expt = experiments[0]
+    detector = expt.detector
+    calculator = search_beam_position._OriginOffsetRlpCalculator(expt, reflections)
+    for offset in ((0, 0, 0), (0.5, -1.2, 0), (-2.0, 0.3, 0.1)):
+        offset = scitbx.matrix.col(offset)
+        expt.detector = dps_extended.get_new_detector(detector, offset)
+        reflections.map_centroids_to_reciprocal_space([expt])
+        rlp = calculator.rlp(offset)
+        assert (rlp - reflections["rlp"]).norms().all_lt(1e-10)
+
+
+def test_score_origin_offsets_parallel(dials_data):
+    """Check that scoring in a process pool matches scoring serially."""
+    from dials.algorithms.indexing.indexer import find_max_cell
+
+    insulin = dials_data("insulin_processed", pathlib=True)
+    experiments = load.experiment_list(insulin / "imported.expt", check_format=False)
+    reflections = flex.reflection_table.from_file(insulin / "strong.refl")
+    reflections["imageset_id"] = flex.int(len(reflections), 0)
+    reflections.centroid_px_to_mm(experiments)
+    reflections.map_centroids_to_reciprocal_space(experiments)
+    max_cell = find_max_cell(
+        reflections, max_cell_multiplier=1.3, step_size=45
+    ).max_cell
+
+    expt = experiments[0]
+    result = search_beam_position.run_dps(expt, reflections, max_cell)
+    experiment_data = [
+        (
+            search_beam_position._OriginOffsetRlpCalculator(expt, reflections),
+            result["solutions"],
+            result["amax"],
+        )
+    ]
+    trial_offsets = [
+        scitbx.matrix.col((x, y, 0)) for y in (-0.5, 0, 0.5) for x in (-0.5, 0, 0.5)
+    ]
+
+    scoring_data = search_beam_position._get_scoring_data(experiment_data)
+    serial_scores = [
+        search_beam_position._score_origin_offset(offset, scoring_data)
+        for offset in trial_offsets
+    ]
+    scores = search_beam_position._score_origin_offsets(
+        trial_offsets, experiment_data, nproc=2
+    )
+    assert scores == pytest.approx(serial_scores)